@@ -0,0 +1,83 @@
+import os
+import tempfile
+import unittest
+from unittest import mock
+
+from ugit import data
+
+
+class RepositoryTestCase(unittest.TestCase):
+   """
+    Runs each test in a new empty directory, which is removed afterwards.
+   """
+
+   def setUp(self):
+      self.cwd = os.getcwd()
+      self.tmp = tempfile.TemporaryDirectory()
+      os.chdir(self.tmp.name)
+
+   def tearDown(self):
+      os.chdir(self.cwd)
+      self.tmp.cleanup()
+
+   def enter_new_directory(self):
+      path = tempfile.mkdtemp(dir=self.tmp.name)
+      os.chdir(path)
+      return path
+
+
+class ObjectFormatTest(RepositoryTestCase):
+
+   @unittest.skipUnless(data.blake3, 'needs the blake3 package')
+   def test_repositories_of_different_formats_in_one_process(self):
+      blake3_repo = self.enter_new_directory()
+      data.init('blake3')
+      self.assertEqual(len(data.hash_object(b'x')), 64)
+
+      self.enter_new_directory()
+      data.init('sha1')
+      oid = data.hash_object(b'x')
+      self.assertEqual(len(oid), 40)
+      self.assertEqual(data.get_object(oid), b'x')
+
+      os.chdir(blake3_repo)
+      self.assertEqual(len(data.hash_object(b'y')), 64)
+
+
+class ObjectStoreTest(RepositoryTestCase):
+
+   def test_falls_back_when_the_anonymous_file_cant_be_opened(self):
+      self.enter_new_directory()
+      data.init()
+      # Opening a directory for writing fails, as O_TMPFILE does on a filesystem without it
+      with mock.patch.object(data, '_supports_tmpfile', return_value=True), \
+           mock.patch.object(data.os, 'O_TMPFILE', os.O_DIRECTORY):
+         oid = data.hash_object(b'x')
+      self.assertEqual(data.get_object(oid), b'x')
+      self.assertEqual(os.listdir(os.path.join(data.GIT_DIR, 'objects')), [oid])
+
+
+class RefTest(RepositoryTestCase):
+
+   def test_update_ref_in_a_second_repository(self):
+      for _ in range(2):
+         self.enter_new_directory()
+         data.init()
+         oid = data.hash_object(b'x')
+         data.update_ref('refs/heads/master', data.RefValue(symbolic=False, value=oid))
+         self.assertEqual(data.get_ref('refs/heads/master').value, oid)
+
+   def test_ref_table_after_moving_to_another_repository(self):
+      repos = {}
+      for content in (b'x', b'y'):
+         repo = self.enter_new_directory()
+         data.init()
+         repos[repo] = data.hash_object(content)
+         data.update_ref('refs/heads/master', data.RefValue(symbolic=False, value=repos[repo]))
+
+      for repo, oid in repos.items():
+         os.chdir(repo)
+         self.assertEqual(data.load_all_refs()['refs/heads/master'], oid)
+
+if __name__ == '__main__':
+   unittest.main()
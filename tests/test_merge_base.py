@@ -0,0 +1,78 @@
+import os
+import tempfile
+import unittest
+from unittest import mock
+
+from ugit import base
+from ugit import data
+
+
+def make_commit(message, *parents):
+   commit = f"tree {data.hash_object(b'', 'tree')}\n"
+   for parent in parents:
+      commit += f"parent {parent}\n"
+   commit += f"\n{message}\n"
+   return data.hash_object(commit.encode(), 'commit')
+
+
+class MergeBaseTest(unittest.TestCase):
+
+   def setUp(self):
+      self.cwd = os.getcwd()
+      self.tmp = tempfile.TemporaryDirectory()
+      os.chdir(self.tmp.name)
+      data.init()
+
+   def tearDown(self):
+      os.chdir(self.cwd)
+      self.tmp.cleanup()
+
+   def test_merge_below_a_long_first_parent_line(self):
+      """
+         R---P1---...---P10---M
+          \\                  /
+           F1---F2-----------
+                  \\
+                   G
+      """
+      R = make_commit('R')
+
+      P = R
+      for i in range(1, 11):
+         P = make_commit(f'P{i}', P)
+
+      F1 = make_commit('F1', R)
+      F2 = make_commit('F2', F1)
+      M = make_commit('M', P, F2)
+      G = make_commit('G', F2)
+
+      self.assertEqual(base.get_merge_base(M, G), F2)
+      self.assertEqual(base.get_merge_base(G, M), F2)
+
+   def test_linear_history(self):
+      C = make_commit('C')
+      A = make_commit('A', make_commit('A1', C))
+      B = make_commit('B', C)
+
+      self.assertEqual(base.get_merge_base(A, B), C)
+
+   def test_stops_at_the_merge_base(self):
+      """
+         o---...---o---B---X1---X2
+                        \\
+                         Y1---Y2
+      """
+      B = make_commit('B0')
+      for i in range(1, 3000):
+         B = make_commit(f'B{i}', B)
+      X = make_commit('X2', make_commit('X1', B))
+      Y = make_commit('Y2', make_commit('Y1', B))
+
+      with mock.patch.object(base, '_parents_only', wraps=base._parents_only) as parents_only:
+         self.assertEqual(base.get_merge_base(X, Y), B)
+      # The two commits on each side and the merge base itself, none of the history below it
+      self.assertEqual(parents_only.call_count, 5)
+
+
+if __name__ == '__main__':
+   unittest.main()
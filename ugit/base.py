@@ -1,11 +1,19 @@
+import functools
 import os
-import itertools
-import operator
+import re
 import string
-from collections import namedtuple, deque
+import sys
+from collections import namedtuple, deque, defaultdict
+from concurrent.futures import ThreadPoolExecutor
 
 from . import data
 from . import diff
+from . import index
+
+# Number of files read or written concurrently by the thread pools below. Blocking reads on
+# this many threads keep the disk queue full, which is what matters on SSDs, so it doesn't
+# depend on the number of cores
+IO_DEPTH = 32
 
 """
    Our .git/objects folder consits of object files. Object files names are the hashed version of their inner content.
@@ -61,13 +69,16 @@ from . import diff
                          branch2
 """
 
-def init():
-   data.init()
+def init(object_format=data.DEFAULT_OBJECT_FORMAT):
+   data.init(object_format)
    data.update_ref("HEAD", data.RefValue(symbolic=True, value = os.path.join("refs", "heads", "master")))
 
 def write_tree (directory='.'):
    """
-    Recursively builds a tree object from the given directory.
+    Builds a tree object from the given directory.
+
+    The files are collected first and hashed concurrently, then the tree objects
+    are assembled bottom-up from the resulting blob OIDs.
 
     Args:
         directory (str): The path to the directory to build the tree from.
@@ -75,25 +86,96 @@ def write_tree (directory='.'):
     Returns:
         str: The hash (OID) of the tree object representing the directory structure.
    """
-   entries = []
-   with os.scandir(directory) as it:
-      for entry in it:
-         full = os.path.join(directory,entry.name)
-         if is_ignored(full):
-               continue
+   directory = os.path.normpath (directory)
+   files, directories = _scan_directory (directory)
+
+   entries = defaultdict (list)
+   for path, oid in _hash_files (files).items ():
+      entries[os.path.dirname (path)].append ((os.path.basename (path), oid, 'blob'))
+
+   # Trees at the same depth don't depend on each other, so each level is stored in one batch,
+   # deepest first so that every subtree is written before the tree that contains it
+   levels = defaultdict (list)
+   for path in directories:
+      levels[path.count (os.sep)].append (path)
+
+   for depth in sorted (levels, reverse=True):
+      trees = []
+      for path in levels[depth]:
+         parts = []
+         for name, oid, type_ in sorted (entries[path]):
+            parts += (type_.encode (), b' ', oid.encode (), b' ', os.fsencode (name), b'\n')
+         trees.append (b''.join (parts))
+
+      for path, oid in zip (levels[depth], data.hash_objects (trees, 'tree')):
+         if path == directory:
+            return oid
+         entries[os.path.dirname (path)].append ((os.path.basename (path), oid, 'tree'))
+
+def _hash_files (files):
+   """
+    Stores the given files as blobs and refreshes the index with them.
+
+    Files whose stat matches the index are known not to have changed since they
+    were hashed, so their cached OID is reused. The rest are hashed concurrently.
 
-         if entry.is_file (follow_symlinks=False):
-            type_ = 'blob'
-            with open (full, 'rb') as f:
-               oid = data.hash_object (f.read ())
-         elif entry.is_dir (follow_symlinks=False):
-            type_ = 'tree'
-            oid = write_tree (full)
-         entries.append ((entry.name, oid, type_))
+    Args:
+        files (list): (path, stat) pairs, as returned by _scan_directory.
+
+    Returns:
+        dict: A dictionary mapping each path to its blob OID, in the order of files.
+   """
+   cached = index.load_index ()
+   updated = {}
+   oids = {}
+   misses = []
+   for path, stat in files:
+      oid = index.get_oid (cached, os.path.normpath (path), stat)
+      if oid:
+         oids[path] = oid
+         updated[os.path.normpath (path)] = index.make_entry (stat, oid)
+      else:
+         misses.append ((path, stat))
 
-   tree = ''.join(f'{type_} {oid} {name}\n' for name, oid, type_ in sorted (entries))
-   return data.hash_object(tree.encode(), 'tree')
+   # Largest files go first so that a big file picked up last does not hold up the pool
+   misses.sort (key=lambda file: file[1].st_size, reverse=True)
+   with ThreadPoolExecutor (max_workers=IO_DEPTH) as executor:
+      blobs = executor.map (data.hash_file, [path for path, _ in misses])
 
+      for (path, stat), oid in zip (misses, blobs):
+         oids[path] = oid
+         updated[os.path.normpath (path)] = index.make_entry (stat, oid)
+   index.save_index (updated)
+
+   return {path: oids[path] for path, _ in files}
+
+def _scan_directory (directory):
+   """
+    Collects the files and subdirectories under the given directory without recursing.
+
+    Returns:
+        tuple: A list of (path, stat) pairs for the files and a list of the directory paths,
+        with every directory listed before its subdirectories.
+   """
+   files = []
+   directories = [directory]
+   stack = [directory]
+   while stack:
+      current = stack.pop ()
+      with os.scandir (current) as it:
+         for entry in it:
+            # Parents were checked before descending, so only the name itself can be ignored
+            if entry.name == data.GIT_DIR:
+               continue
+
+            # DirEntry answers these from the d_type returned by readdir, so
+            # they cost no extra stat on filesystems that report it
+            if entry.is_file (follow_symlinks=False):
+               files.append ((entry.path, entry.stat (follow_symlinks=False)))
+            elif entry.is_dir (follow_symlinks=False):
+               directories.append (entry.path)
+               stack.append (entry.path)
+   return files, directories
 
 def _iter_tree_entries (oid):
    """
@@ -102,9 +184,14 @@ def _iter_tree_entries (oid):
    if not oid:
       return
    tree = data.get_object (oid, 'tree')
-   for entry in tree.decode().splitlines():
-      type_, oid, name = entry.split(' ', 2)
-      yield type_, oid, name
+   # Entries are parsed as bytes, only the fields themselves get decoded. OIDs are interned:
+   # unchanged files keep their OID across commits, so every cached tree shares one string
+   # per OID, and comparing two equal OIDs is an identity check
+   for entry in tree.split(b'\n'):
+      if not entry:
+         continue
+      type_, oid, name = entry.split(b' ', 2)
+      yield type_.decode(), sys.intern(oid.decode()), os.fsdecode(name)
 
 
 def get_tree (oid, base_path=''):
@@ -118,50 +205,66 @@ def get_tree (oid, base_path=''):
     Returns:
         dict: A dictionary representing the tree structure.
    """
-   result = {}
+   # Callers get their own dict, the cached arrays are shared and must stay untouched
+   tree = _get_tree_arrays (oid, base_path)
+   return dict (zip (tree.paths, tree.oids))
+
+# A flattened tree, kept as two parallel tuples instead of a tuple of (path, oid) pairs,
+# which saves a tuple object per file in every cached tree
+Tree = namedtuple('Tree', ['paths', 'oids'])
+
+@functools.lru_cache (maxsize=4096)
+def _get_tree_arrays (oid, base_path):
+   """
+    Flattens a tree into a Tree of parallel path and OID tuples. Objects never change,
+    so the result is cached, and subtrees shared between commits are only read once.
+   """
+   paths = []
+   oids = []
    for type_, oid, name in _iter_tree_entries (oid):
       assert '/' not in name
       assert name not in ('..', '.')
       path = os.path.join(base_path, name)
       if type_ == 'blob':
-         result[path] = oid
+         paths.append (path)
+         oids.append (oid)
       elif type_ == 'tree':
-         result.update(get_tree (oid, os.path.join(path, '')))
+         subtree = _get_tree_arrays (oid, os.path.join(path, ''))
+         paths.extend (subtree.paths)
+         oids.extend (subtree.oids)
       else:
          assert False, f'Unknown tree entry {type_}'
-   return result
+   return Tree (tuple (paths), tuple (oids))
 
 def get_working_tree():
-   result = {}
-   for root, _, filenames in os.walk("."):
-      for filename in filenames:
-         path = os.path.relpath(os.path.join(root, filename))
-         if is_ignored(path) or not os.path.isfile(path):
-            continue
-         with open(path, 'rb') as f:
-            result[path] = data.hash_object(f.read())
-   return result
+   files, _ = _scan_directory ('.')
+   return {os.path.normpath(path): sys.intern(oid) for path, oid in _hash_files(files).items()}
 
 def _empty_current_directory ():
    """
     Empties the current directory of all files and subdirectories.
    """
-   for root, dirnames, filenames in os.walk ('.', topdown=False):
-      for filename in filenames:
-         path = os.path.relpath(os.path.join(root,filename))
-         if is_ignored (path) or not os.path.isfile (path):
-            continue
-         os.remove (path)
-      for dirname in dirnames:
-         path = os.path.relpath(os.path.join(root, dirname))
-         if is_ignored (path):
-            continue
-         try:
-            os.rmdir (path)
-         except (FileNotFoundError, OSError):
-            # Deletion might fail if the directory contains ignored files,
-            # so it's OK
-            pass
+   directories = []
+   stack = ['.']
+   while stack:
+      with os.scandir (stack.pop ()) as it:
+         for entry in it:
+            if entry.name == data.GIT_DIR:
+               continue
+            if entry.is_dir (follow_symlinks=False):
+               directories.append (entry.path)
+               stack.append (entry.path)
+            elif entry.is_file (follow_symlinks=False):
+               os.remove (entry.path)
+
+   # Parents were found before their subdirectories, so remove in reverse
+   for path in reversed (directories):
+      try:
+         os.rmdir (path)
+      except (FileNotFoundError, OSError):
+         # Deletion might fail if the directory contains ignored files,
+         # so it's OK
+         pass
 
 def read_tree (tree_oid):
    """
@@ -171,10 +274,18 @@ def read_tree (tree_oid):
         tree_oid (str): The OID of the tree object to read.
    """
    _empty_current_directory ()
-   for path, oid in get_tree (tree_oid, base_path='./').items():
-      os.makedirs (os.path.dirname (path), exist_ok=True)
-      with open (path, 'wb') as f:
-         f.write (data.get_object (oid))
+   tree = get_tree (tree_oid, base_path='./')
+   for directory in {os.path.dirname (path) for path in tree}:
+      os.makedirs (directory, exist_ok=True)
+
+   # Every file goes to a different path, so objects can be read and written out concurrently
+   with ThreadPoolExecutor (max_workers=IO_DEPTH) as executor:
+      for _ in executor.map (_restore_file, tree.keys (), tree.values ()):
+         pass
+
+def _restore_file (path, oid):
+   with open (path, 'wb') as f:
+      f.write (data.get_object (oid))
 
 def read_tree_merged(t_HEAD, t_other):
    _empty_current_directory()
@@ -247,6 +358,11 @@ def merge(other):
    read_tree_merged(c_HEAD.tree, c_other.tree)
    print("Merged in working tree\nPlease commit")
 
+# Marks of get_merge_base: which of the two commits a commit is reachable from, and whether it's
+# below a commit reachable from both
+_FROM_1, _FROM_2, _STALE = 1, 2, 4
+_FROM_BOTH = _FROM_1 | _FROM_2
+
 def get_merge_base(oid1, oid2):
    """
       Finds the firt common ancestor of two commits
@@ -259,13 +375,50 @@ def get_merge_base(oid1, oid2):
                   commit B
       (In this example C is the common ancestor of A and B)
    """
-   # Saves all parents of the first commit to a set and it iterates over the parents of the 
-   # second commit in ancestry order until it reaches a parent that is a parent of the first commit
-   parents1 = set(iter_commits_and_parents({oid1}))
-
-   for oid in iter_commits_and_parents({oid2}):
-      if oid in parents1:
-         return oid
+   # Walks down from both commits at once, breadth-first, marking each commit with the sides it's
+   # reachable from. A commit reached from both sides is a candidate, and everything below it is
+   # marked stale: those commits are common ancestors as well, but older ones. The walk stops once
+   # only stale commits are left to visit, so the history below the merge base is never read
+   flags = defaultdict(int)
+   flags[oid1] |= _FROM_1
+   flags[oid2] |= _FROM_2
+   queue = deque(flags)
+   queued = set(queue)
+   active = len(queue) # Queued commits that aren't stale
+   candidates = []
+
+   while active:
+      oid = queue.popleft()
+      queued.remove(oid)
+      flag = flags[oid]
+      if not flag & _STALE:
+         active -= 1
+         if flag & _FROM_BOTH == _FROM_BOTH:
+            candidates.append(oid)
+            flag |= _STALE
+
+      for parent in _parents_only(oid):
+         old = flags[parent]
+         new = flags[parent] = old | flag
+         if new == old:
+            continue
+         if parent not in queued:
+            queue.append(parent)
+            queued.add(parent)
+            active += not new & _STALE
+         elif new & _STALE and not old & _STALE:
+            active -= 1
+
+   # Breadth-first order doesn't guarantee a candidate is visited before the candidates below it.
+   # Those that turned out to be stale are dropped, and when more than one is left (criss-cross
+   # merges), so are those below another candidate, which needs a walk under the candidates
+   bases = [oid for oid in candidates if not flags[oid] & _STALE]
+   if len(bases) > 1:
+      below = set(iter_commits_and_parents(parent for oid in bases for parent in _parents_only(oid)))
+      bases = [oid for oid in bases if oid not in below]
+
+   if bases:
+      return bases[0]
 
 def create_tag(name, oid):
    data.update_ref(os.path.join("refs", "tags", name), data.RefValue(symbolic=False, value=oid))
@@ -290,6 +443,7 @@ def get_branch_name():
 
 Commit = namedtuple('Commit', ['tree', 'parents', 'message'])
 
+@functools.lru_cache(maxsize=4096)
 def get_commit(oid):
    """
     Retrieves a commit object from the repository.
@@ -302,19 +456,20 @@ def get_commit(oid):
    """
    parents = []
 
-   commit = data.get_object(oid, 'commit').decode()
-   lines = iter(commit.splitlines())
-   for line in itertools.takewhile(operator.truth, lines):
-      key, value = line.split(' ', 1)
-      if key == 'tree':
-         tree = value
-      elif key == 'parent':
-         parents.append(value)
+   # The header ends at the first blank line, everything after it is the message
+   header, _, message = data.get_object(oid, 'commit').partition(b'\n\n')
+   for line in header.split(b'\n'):
+      key, _, value = line.partition(b' ')
+      if key == b'tree':
+         tree = value.decode()
+      elif key == b'parent':
+         parents.append(value.decode())
       else:
-         assert False, f"Unknown field {key}"
+         assert False, f"Unknown field {key.decode()}"
 
-   message = "\n".join(lines)
-   return Commit(tree= tree, parents= parents, message= message)
+   message = message.decode().removesuffix('\n')
+   # Commits are cached and shared between callers, so the parents are made immutable
+   return Commit(tree= tree, parents= tuple(parents), message= message)
 
 def iter_commits_and_parents(oids):
    oids = deque(oids)
@@ -327,10 +482,32 @@ def iter_commits_and_parents(oids):
       visited.add(oid)
       yield oid
 
-      commit = get_commit(oid)
+      parents = _parents_only(oid)
+      # Linear history is followed directly, the deque only comes into play at merges
+      while len(parents) == 1 and parents[0] not in visited:
+         oid = parents[0]
+         visited.add(oid)
+         yield oid
+         parents = _parents_only(oid)
 
-      oids.extendleft(commit.parents[:1])
-      oids.extend(commit.parents[1:])
+      oids.extendleft(parents[:1])
+      oids.extend(parents[1:])
+
+_PARENT_RE = re.compile(rb'^parent ([0-9a-f]+)$', re.M)
+_parents_cache = {}
+
+def _parents_only(oid):
+   """
+    Returns the parent OIDs of a commit without parsing the rest of it.
+    Only the header is searched, the message is never decoded. Commits are immutable,
+    so the result is remembered for the rest of the process.
+   """
+   parents = _parents_cache.get(oid)
+   if parents is None:
+      commit = data.get_object(oid, 'commit')
+      header = commit[:commit.find(b'\n\n')]
+      parents = _parents_cache[oid] = [parent.decode() for parent in _PARENT_RE.findall(header)]
+   return parents
 
 def get_oid(name):
    if name == '@': name = "HEAD"
@@ -342,16 +519,14 @@ def get_oid(name):
       os.path.join("refs", "heads", name ),
    ]
 
+   refs = data.load_all_refs()
    for ref in refs_to_try:
-      if data.get_ref(ref, deref=False).value:
-         return data.get_ref(ref).value
+      if ref in refs:
+         return refs[ref]
       
    is_hex = all( map(lambda x : x in string.hexdigits, name)) 
-   if len(name) == 40 and is_hex:
+   # 40 digits for SHA-1 OIDs, 64 for BLAKE3 ones
+   if len(name) in (40, 64) and is_hex:
       return name
    
    assert False, f"Unknown name {name}"
-   
-
-def is_ignored(path):
-   return '.ugit' in path.split(os.path.sep)
\ No newline at end of file
@@ -23,6 +23,7 @@ def parse_args():
 
    init_parser = commands.add_parser ('init')
    init_parser.set_defaults(func=init)
+   init_parser.add_argument('--object-format', choices=data.OBJECT_FORMATS, default=data.DEFAULT_OBJECT_FORMAT)
 
    hash_object_parser = commands.add_parser ('hash-object')
    hash_object_parser.set_defaults(func=hash_object)
@@ -88,12 +89,11 @@ def parse_args():
    return parser.parse_args()
 
 def init (args):
-   base.init()
+   base.init(args.object_format)
    print(f'Initialized empty ugit repository in {os.getcwd()}/{data.GIT_DIR}')
 
 def hash_object (args):
-   with open (args.file, 'rb') as f:
-      print (data.hash_object (f.read ()))
+   print (data.hash_file (args.file))
 
 def cat_file (args):
    sys.stdout.flush ()
@@ -1,12 +1,96 @@
+import contextlib
+import functools
+import itertools
 import hashlib
+import mmap
 import os
-from collections import namedtuple
+import sys
+import threading
+from collections import namedtuple, OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+   import blake3
+except ImportError:
+   blake3 = None
+
+try:
+   import zstandard
+except ImportError:
+   zstandard = None
 
 GIT_DIR = '.ugit'
 
-def init ():
+# Hash functions an object store can be created with. The choice is recorded in .ugit/format
+# and OIDs of different formats never mix within a repository
+OBJECT_FORMATS = ('sha1', 'blake3')
+
+# New repositories use BLAKE3 whenever the blake3 package is installed. It's several times faster
+# than SHA-1 on large blobs, and unlike SHA-1 it isn't broken. The full 256 bit digest is kept
+DEFAULT_OBJECT_FORMAT = 'blake3' if blake3 else 'sha1'
+
+# Objects are stored zstd-compressed when the zstandard package is available. OIDs are always
+# computed over the uncompressed bytes, so compressed and raw objects can live side by side
+ZSTD_MAGIC = b'\x28\xb5\x2f\xfd'
+
+# Objects are read, hashed and written this many bytes at a time
+CHUNK_SIZE = 1 << 20
+
+# Files up to this size are read whole and hashed before being written, larger ones are streamed
+STREAM_THRESHOLD = 4 << 20
+
+# OIDs stay hex strings in memory rather than raw digests. Tree entries, refs, object file names
+# and the CLI all use the hex form, so a binary OID would have to be converted back at each of
+# those boundaries. The digest is formatted once, when the object is hashed, and repeated OIDs
+# share a single interned string (see base._iter_tree_entries)
+
+# SHA-1 is the bulk of the work when hashing objects. hashlib.sha1 is OpenSSL's implementation
+# whenever Python is linked against OpenSSL, and OpenSSL switches to the SHA-NI instructions at
+# runtime on CPUs that have them (sha_ni in /proc/cpuinfo), so there is nothing to build for it.
+# Only Python's bundled fallback lacks that code path. To verify on a given machine:
+#    python -c "import hashlib; print(hashlib.sha1)"   -> should print <built-in function openssl_sha1>
+#    openssl speed -evp sha1                           -> compare against the same command run
+#                                                         with OPENSSL_ia32cap=:~0x20000000 (SHA-NI off)
+# Restricted environments (e.g. FIPS policies) may block SHA-1 unless it's declared as not being used
+# for security. Object IDs only name content, so the declaration keeps OpenSSL's implementation usable there
+_sha1 = functools.partial(hashlib.sha1, usedforsecurity=False)
+
+# Format of each repository used so far, by absolute path of its .ugit directory. A process
+# can move between repositories (e.g. chdir then init), and they may use different formats
+_object_formats = {}
+
+def init (object_format=DEFAULT_OBJECT_FORMAT):
+   assert object_format in OBJECT_FORMATS, f'Unknown object format {object_format}'
+   assert object_format != 'blake3' or blake3, 'The blake3 object format needs the blake3 package'
    os.makedirs(GIT_DIR)
    os.makedirs(os.path.join(GIT_DIR, 'objects'))
+   with open(os.path.join(GIT_DIR, 'format'), 'w') as f:
+      f.write(object_format)
+   _object_formats[os.path.abspath(GIT_DIR)] = object_format
+
+def get_object_format ():
+   """
+    Returns the hash function the repository names its objects with.
+    Repositories created before .ugit/format existed use SHA-1.
+   """
+   git_dir = os.path.abspath(GIT_DIR)
+   object_format = _object_formats.get(git_dir)
+   if object_format is None:
+      try:
+         with open(os.path.join(git_dir, 'format')) as f:
+            object_format = f.read().strip()
+      except FileNotFoundError:
+         object_format = 'sha1'
+      assert object_format in OBJECT_FORMATS, f'Unknown object format {object_format}'
+      assert object_format != 'blake3' or blake3, 'This repository uses blake3 OIDs, install the blake3 package'
+      _object_formats[git_dir] = object_format
+   return object_format
+
+def _new_hash (data=b''):
+   if get_object_format() == 'blake3':
+      # BLAKE3 is a tree hash, so a single large object gets hashed on all cores
+      return blake3.blake3(data, max_threads=blake3.blake3.AUTO)
+   return _sha1(data)
 
 
 def hash_object (data, type_='blob'):
@@ -17,19 +101,197 @@ def hash_object (data, type_='blob'):
       data: The data to be hashed and stored.
       type_ (str): The type of the object ('blob' for file content, 'tree' for directory content).
 
+   Returns:
+      str: The hash (OID) of the stored object.
+   """
+   h = _new_hash (type_.encode () + b'\x00')
+   h.update (data)
+   oid = h.hexdigest ()
+   # The data is already in memory, so it's hashed before anything is written and an object that is
+   # already stored (e.g. an unchanged subtree) costs a single stat instead of a write
+   if os.path.exists (os.path.join (GIT_DIR, 'objects', oid)):
+      return oid
+
+   # Trees and commits are small, their data goes to the file as is. Only large
+   # blobs are cut into chunks, as views so that nothing gets copied
+   if len (data) <= CHUNK_SIZE:
+      return _store_object (type_, (data,), oid)
+   view = memoryview (data)
+   return _store_object (type_, (view[i:i + CHUNK_SIZE] for i in range (0, len (view), CHUNK_SIZE)), oid)
+
+def hash_objects (datas, type_='blob'):
+   """
+    Hashes and stores several objects of the same type at once.
+    The objects are independent, so they are hashed and written concurrently.
+
+   Args:
+      datas (list): The data of each object.
+      type_ (str): The type of the objects.
+
+   Returns:
+      list: The hashes (OIDs) of the stored objects, in the order of datas.
+   """
+   if len (datas) < 2:
+      return [hash_object (data, type_) for data in datas]
+   with ThreadPoolExecutor () as executor:
+      return list (executor.map (hash_object, datas, itertools.repeat (type_)))
+
+def hash_file (path, type_='blob'):
+   """
+    Hashes the file at the given path and stores it in the ugit objects directory.
+    Files larger than STREAM_THRESHOLD are streamed, so they're never held in memory as a whole.
+
+   Args:
+      path (str): The path of the file to be hashed and stored.
+      type_ (str): The type of the object.
+
+   Returns:
+      str: The hash (OID) of the stored object.
+   """
+   with open (path, 'rb', buffering=0) as f:
+      if os.fstat (f.fileno ()).st_size <= STREAM_THRESHOLD:
+         # Goes through hash_object, which hashes before writing, so a file whose blob is already
+         # stored (e.g. every file just restored by a checkout) is only read, never written again
+         return hash_object (f.read (), type_)
+      if hasattr (os, 'posix_fadvise'):
+         # The whole file is read front to back, let the kernel read ahead further
+         os.posix_fadvise (f.fileno (), 0, 0, os.POSIX_FADV_SEQUENTIAL)
+      return _store_object (type_, _read_chunks (f))
+
+# Read buffers of _read_chunks, one per thread
+_chunk_buffers = threading.local ()
+
+def _read_chunks (f):
+   # Each thread refills the same buffer for every file it hashes, instead of allocating new bytes
+   # for every chunk, or a new buffer per file. Each chunk is fully consumed by the hash and the
+   # writer before the next one is read
+   view = getattr (_chunk_buffers, 'view', None)
+   if view is None:
+      view = _chunk_buffers.view = memoryview (bytearray (CHUNK_SIZE))
+   while True:
+      size = f.readinto (view)
+      if not size:
+         return
+      yield view[:size]
+
+def _store_object (type_, chunks, oid=None):
+   """
+    Writes an object to a temporary file while hashing it, then names the file after the resulting OID.
+    Each chunk is passed to the hash and to the file right after it's read, so the content is
+    gone over once instead of being hashed as a whole first and then written out.
+    An interrupted write never leaves a truncated object behind, at most a temporary file.
+
+   Args:
+      type_ (str): The type of the object.
+      chunks: The content of the object, as an iterable of bytes-like objects.
+      oid (str): The OID of the object if the caller already hashed it, in which case it's only written.
+
    Returns:
       str: The hash (OID) of the stored object.
    """
 
    #Object have thier type prepended to them as data so we can distinquish between types
    #This allows us to differentiate blob and tree files
+   header = type_.encode () + b'\x00'
+   h = None if oid else _new_hash (header)
+   directory = os.path.join (GIT_DIR, 'objects')
+   out, tmp = _open_temp (directory)
+   try:
+      with out:
+         with _compressed (out) as writer:
+            writer.write (header)
+            for chunk in chunks:
+               if h is not None:
+                  h.update (chunk)
+               writer.write (chunk)
+
+         oid = oid or h.hexdigest () # Name is hashed
+         path = os.path.join (directory, oid)
+         if tmp is None:
+            # The file has no name yet, it's linked into place only now that it's complete.
+            # Objects are content-addressed, so an existing file already holds the exact same bytes
+            out.flush ()
+            with contextlib.suppress (FileExistsError):
+               _link_tmpfile (out.fileno (), path)
+            return oid
 
-   obj = type_.encode () + b'\x00' + data # Contents are only encoded 
-   oid = hashlib.sha1(obj).hexdigest () # Name is hashed
-   with open(os.path.join(GIT_DIR, 'objects', oid), 'wb') as out:
-      out.write(obj)
+      if os.path.exists (path):
+         os.remove (tmp)
+      else:
+         os.replace (tmp, path)
+   except BaseException:
+      if tmp is not None:
+         with contextlib.suppress (FileNotFoundError):
+            os.remove (tmp)
+      raise
    return oid
 
+def _open_temp (directory):
+   """
+    Opens a file to write a new object into, returning it along with its temporary path.
+    On Linux the file is created with O_TMPFILE, which has no path (None is returned for it):
+    it never shows up in the directory, and is freed by the kernel if the write is interrupted.
+   """
+   if _supports_tmpfile (os.path.abspath (directory)):
+      # Support was probed once for this directory, but an open that still fails falls back as well
+      with contextlib.suppress (OSError):
+         return os.fdopen (os.open (directory, os.O_TMPFILE | os.O_WRONLY, 0o666), 'wb'), None
+   tmp = _temp_path (directory)
+   return open (tmp, 'wb'), tmp
+
+@functools.lru_cache ()
+def _supports_tmpfile (directory):
+   # O_TMPFILE depends on the filesystem, and linking the file needs /proc, so both are tried once
+   # per directory. It's given as an absolute path, a process can move to another repository
+   if not hasattr (os, 'O_TMPFILE'):
+      return False
+   probe = _temp_path (directory)
+   try:
+      fd = os.open (directory, os.O_TMPFILE | os.O_WRONLY, 0o666)
+      try:
+         _link_tmpfile (fd, probe)
+      finally:
+         os.close (fd)
+      os.remove (probe)
+   except OSError:
+      return False
+   return True
+
+def _link_tmpfile (fd, path):
+   # The /proc link has to be followed, which only linkat does. Python calls plain link unless a
+   # directory fd is given, so the file's own fd is passed, the kernel ignores it for an absolute path
+   os.link (f'/proc/self/fd/{fd}', path, src_dir_fd=fd)
+
+# zstd contexts, one per thread: a context can be reused for any number of objects, one at a
+# time, and setting one up costs more than compressing or decompressing a small object
+_zstd_contexts = threading.local ()
+
+def _compressed (out):
+   if zstandard:
+      compressor = getattr (_zstd_contexts, 'compressor', None)
+      if compressor is None:
+         # Level 1 compresses source text several times over at hundreds of MB/s,
+         # which costs less than the disk bandwidth it saves
+         compressor = _zstd_contexts.compressor = zstandard.ZstdCompressor (level=1)
+      return compressor.stream_writer (out, closefd=False)
+   return contextlib.nullcontext (out)
+
+def _temp_path (directory):
+   # Unique per thread, so that concurrent writers never share a temporary file
+   return os.path.join (directory, f'.tmp-{os.getpid ()}-{threading.get_ident ()}')
+
+# Objects are immutable once written, so a cached read never goes stale. The cache is bounded
+# by the total size of the cached contents rather than a number of entries, since a few large
+# blobs could otherwise pin a lot of memory
+OBJECT_CACHE_SIZE = 64 << 20
+
+# Objects from this size up are read through mmap
+MMAP_THRESHOLD = 256 << 10
+
+_object_cache = OrderedDict()
+_object_cache_size = 0
+_object_cache_lock = threading.Lock()
+
 def get_object (oid, expected='blob'):
    """
     Retrieves the object with the given OID from the ugit objects directory.
@@ -44,16 +306,58 @@ def get_object (oid, expected='blob'):
     Raises:
         AssertionError: If the retrieved object's type does not match the expected type.
    """
-   with open(os.path.join(GIT_DIR, 'objects', oid), 'rb') as f:
-      obj = f.read ()
+   with _object_cache_lock:
+      obj = _object_cache.get (oid)
+      if obj:
+         _object_cache.move_to_end (oid)
 
-   type_, _, content = obj.partition (b'\x00')
-   type_ = type_.decode ()
+   if obj is None:
+      obj = _read_object (oid)
+      _cache_object (oid, obj)
 
+   type_, content = obj
    if expected is not None:
       assert type_ == expected, f'Expected {expected}, got {type_}'
    return content
 
+def _read_object (oid):
+   with open(os.path.join(GIT_DIR, 'objects', oid), 'rb') as f:
+      # Large objects are mapped instead of read, so their content is copied only once, from the
+      # page cache straight into the returned bytes. Mapping costs more than reading small files
+      if os.fstat (f.fileno ()).st_size < MMAP_THRESHOLD:
+         return _parse_object (oid, f.read ())
+      with mmap.mmap (f.fileno (), 0, access=mmap.ACCESS_READ) as buf:
+         return _parse_object (oid, buf)
+
+def _parse_object (oid, buf):
+   """
+    Splits a stored object, given as bytes or any buffer supporting find and slicing, into its type and content.
+   """
+   if buf[:len (ZSTD_MAGIC)] == ZSTD_MAGIC:
+      assert zstandard, f'Object {oid} is compressed, install the zstandard package'
+      decompressor = getattr (_zstd_contexts, 'decompressor', None)
+      if decompressor is None:
+         decompressor = _zstd_contexts.decompressor = zstandard.ZstdDecompressor ()
+      buf = decompressor.decompressobj ().decompress (buf)
+
+   nul = buf.find (b'\x00')
+   return buf[:nul].decode (), buf[nul + 1:]
+
+def _cache_object (oid, obj):
+   global _object_cache_size
+   size = len (obj[1])
+   if size > OBJECT_CACHE_SIZE:
+      return
+
+   with _object_cache_lock:
+      if oid in _object_cache:
+         return
+      _object_cache[oid] = obj
+      _object_cache_size += size
+      while _object_cache_size > OBJECT_CACHE_SIZE:
+         _, (_, evicted) = _object_cache.popitem (last=False)
+         _object_cache_size -= len (evicted)
+
 RefValue = namedtuple("RefValue", ["symbolic", "value"])
 
 def update_ref(ref, value, deref= True):
@@ -77,9 +381,19 @@ def update_ref(ref, value, deref= True):
       value = value.value 
 
    ref_path = os.path.join(GIT_DIR, ref)
-   os.makedirs(os.path.dirname(ref_path), exist_ok= True)
-   with open(ref_path, 'w') as f:
+
+   # Write a temporary file outside refs/ and rename it over the ref, so the ref
+   # is never seen half-written and a leftover is never listed as a ref
+   tmp = _temp_path(GIT_DIR)
+   with open(tmp, 'w') as f:
       f.write(value)
+   try:
+      os.replace(tmp, ref_path)
+   except FileNotFoundError:
+      # Only the first ref of a directory (e.g. of refs/tags) has to create it
+      os.makedirs(os.path.dirname(ref_path), exist_ok= True)
+      os.replace(tmp, ref_path)
+   _invalidate_refs()
 
 def get_ref(ref, deref= True):
    """
@@ -97,8 +411,9 @@ def get_ref(ref, deref= True):
 def delete_ref(ref, deref= True):
    ref = _get_ref_internal(ref, deref)[0]
    os.remove(os.path.join(GIT_DIR, ref))
+   _invalidate_refs()
 
-def _get_ref_internal(ref, deref):
+def _get_ref_internal(ref, deref, cache=None):
    """
       When given a non-symbolic ref, _get_ref_internal will return the ref name and value.
       When given a symbolic ref, _get_ref_internal will dereference the ref recursively, and then return the name of the last (non-symbolic) ref that points to an OID, plus its value.
@@ -106,23 +421,37 @@ def _get_ref_internal(ref, deref):
     Args:
         ref (str): The name of the reference.
         deref (bool): Whether to dereference symbolic references.
+        cache (dict): Results of earlier calls to reuse, for callers resolving many refs in a row.
+            Symbolic refs lead to refs that are usually resolved on their own as well.
 
     Returns:
         Tuple[str, RefValue]: A tuple containing the reference name and its value.
    """
-   ref_path = os.path.join(GIT_DIR, ref)
+   if cache is not None and (ref, deref) in cache:
+      return cache[ref, deref]
+
    value = None
-   if os.path.isfile(ref_path):
-      with open(ref_path) as f:
+   try:
+      with open(os.path.join(GIT_DIR, ref)) as f:
          value = f.read().strip()
+   except (FileNotFoundError, IsADirectoryError, NotADirectoryError):
+      pass
    
    symbolic = bool(value) and value.startswith("ref:")
    if symbolic:
       value = value.split(":", 1)[1].strip()
-      if deref:
-         return _get_ref_internal(value, deref=True)
-   
-   return ref, RefValue(symbolic=symbolic, value=value) 
+   elif value:
+      # Same string object as the OIDs in the trees it's compared against
+      value = sys.intern(value)
+
+   if symbolic and deref:
+      result = _get_ref_internal(value, deref=True, cache=cache)
+   else:
+      result = ref, RefValue(symbolic=symbolic, value=value)
+
+   if cache is not None:
+      cache[ref, deref] = result
+   return result
       
 def iter_ref(prefix = '', deref= True):
    """
@@ -135,14 +464,73 @@ def iter_ref(prefix = '', deref= True):
     Yields:
         Tuple[str, RefValue]: A tuple containing the reference name and its value.
    """
-   refs = ['HEAD', 'MERGE_HEAD']
-   for root, _ , filenames in os.walk(os.path.join(GIT_DIR, "refs")):
-      root = os.path.relpath(root, GIT_DIR)
-      refs.extend([os.path.join(root, name) for name in filenames])
-
-   for refname in refs:
+   # Only lives for this iteration, so refs updated in between calls are always read again
+   cache = {}
+   for refname in _iter_ref_names():
       if not refname.startswith(prefix):
          continue
-      ref = get_ref(refname, deref=deref)
+      ref = _get_ref_internal(refname, deref, cache)[1]
       if ref.value:
-         yield refname, ref
\ No newline at end of file
+         yield refname, ref
+
+def _iter_ref_names():
+   yield 'HEAD'
+   yield 'MERGE_HEAD'
+   yield from _walk_refs("refs")
+
+def _walk_refs(base):
+   """
+    Yields the names of the ref files under base, a directory relative to GIT_DIR.
+    scandir reports the type of each entry itself, so unlike os.walk nothing gets stat'ed,
+    and names are built onto base instead of going through os.path.relpath.
+    Like os.walk, the files of a directory come before those of its subdirectories.
+   """
+   try:
+      it = os.scandir(os.path.join(GIT_DIR, base))
+   except FileNotFoundError:
+      return
+
+   subdirs = []
+   with it:
+      for entry in it:
+         name = os.path.join(base, entry.name)
+         if entry.is_dir(follow_symlinks=False):
+            subdirs.append(name)
+         else:
+            yield name
+   for subdir in subdirs:
+      yield from _walk_refs(subdir)
+
+# The ref table along with the absolute path of the .ugit directory it was read from, so that
+# a process moving to another repository doesn't resolve names against the previous one's refs
+_all_refs = None, None
+
+def load_all_refs():
+   """
+    Reads every reference of the repository at once, each ref file being opened a single time.
+    The result is kept until a reference is updated or deleted.
+
+    Returns:
+        dict: A dictionary mapping each existing reference name to the OID it resolves to,
+        or None for a symbolic reference whose target doesn't exist yet.
+   """
+   global _all_refs
+   git_dir = os.path.abspath(GIT_DIR)
+   if _all_refs[0] != git_dir:
+      raw = {}
+      for refname in _iter_ref_names():
+         ref = get_ref(refname, deref=False)
+         if ref.value:
+            raw[refname] = ref
+
+      refs = {}
+      for refname, ref in raw.items():
+         while ref and ref.symbolic:
+            ref = raw.get(ref.value)
+         refs[refname] = ref and ref.value
+      _all_refs = git_dir, refs
+   return _all_refs[1]
+
+def _invalidate_refs():
+   global _all_refs
+   _all_refs = None, None
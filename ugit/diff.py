@@ -1,14 +1,43 @@
 import difflib
 from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
 from tempfile import NamedTemporaryFile as Temp
 from . import data
 import os
 
+try:
+   # Patience diff anchors hunks on lines that appear once on both sides, which gives more
+   # readable hunks for source code, and its matcher is compiled rather than pure Python
+   import patiencediff
+except ImportError:
+   patiencediff = None
+
+try:
+   # Rust port of difflib's unified diff: same output, several times faster
+   from difflib_rs import unified_diff_str
+except ImportError:
+   unified_diff_str = None
+
 def compare_trees(*trees):
    """
     Take a list of trees and return them grouped by filename. 
     This way, for each file we can get all its OIDs in the different trees.
    """
+   if len(trees) == 2:
+      return _compare_two(*trees)
+   return _compare_many(trees)
+
+def _compare_two(t_a, t_b):
+   # Diffs and merges always compare two trees, which is walked without building a list per path.
+   # The lookup is bound once, since it runs for every file of the tree
+   get_b = t_b.get
+   for path, o_a in t_a.items():
+      yield path, o_a, get_b(path)
+   for path, o_b in t_b.items():
+      if path not in t_a:
+         yield path, None, o_b
+
+def _compare_many(trees):
    entries = defaultdict(lambda: [None] * len(trees))
    for i, tree in enumerate(trees):
       for path, oid in tree.items():
@@ -18,51 +47,84 @@ def compare_trees(*trees):
       yield (path, *oids)
 
 def iter_changed_files(t_from, t_to):
-   for path, o_from, o_to in compare_trees(t_from, t_to):
+   for path, o_from, o_to in _compare_two(t_from, t_to):
       if o_from != o_to:
          action = ("new file" if not o_from else
                    "deleted" if not o_to else
                    "modified")
          yield path, action
 
+# Below this many changed files the pool costs more than it saves
+PARALLEL_DIFF_THRESHOLD = 8
+
 def diff_trees(t_from, t_to):
-   output = b''
-   for path, o_from, o_to in compare_trees(t_from, t_to):
-      if o_from != o_to:
-         output += diff_blobs(o_from, o_to, path)
-   return  output
+   changed = [(o_from, o_to, path) for path, o_from, o_to in _compare_two(t_from, t_to) if o_from != o_to]
+   if len(changed) <= PARALLEL_DIFF_THRESHOLD:
+      return b''.join(diff_blobs(*args) for args in changed)
+
+   # Every diff reads its two blobs and diffs them independently, map keeps the output in tree order
+   with ThreadPoolExecutor (max_workers=os.cpu_count()) as executor:
+      return b''.join(executor.map(lambda args: diff_blobs(*args), changed))
 
 def diff_blobs(o_from, o_to, path= "blob"):
    # Get the content of the blobs using the provided object IDs
    content_from = data.get_object(o_from, expected="blob")
    content_to = data.get_object(o_to, expected="blob")
+   fromfile, tofile = f"a/{path}", f"b/{path}"
 
-   # Split the content into lines for diff comparison
-   lines_from = content_from.decode("utf-8").splitlines()
-   lines_to = content_to.decode("utf-8").splitlines()
+   if not patiencediff and not unified_diff_str:
+      # difflib can compare the raw lines directly, so the blobs are never decoded
+      diff = difflib.diff_bytes(difflib.unified_diff, content_from.splitlines(), content_to.splitlines(),
+                                fromfile=os.fsencode(fromfile), tofile=os.fsencode(tofile))
+      return b'\n'.join(diff)
 
-   # Compute the difference between the contents using unified_diff
-   diff = difflib.unified_diff(lines_from, lines_to, fromfile=f"a/{path}", tofile=f"b/{path}")
+   # Compute the difference between the contents using unified_diff, bytes that aren't
+   # valid UTF-8 are carried through as surrogates instead of failing the decode
+   diff = _unified_diff(content_from.decode("utf-8", "surrogateescape"), content_to.decode("utf-8", "surrogateescape"),
+                        fromfile=fromfile, tofile=tofile)
 
    # Join the diff lines into a single string
-   return '\n'.join(diff).encode("utf-8")
+   return '\n'.join(diff).encode("utf-8", "surrogateescape")
+
+def _unified_diff(text_from, text_to, fromfile='', tofile=''):
+   """
+    Iterates over the unified diff of two texts, compared line by line.
+    Uses patiencediff when it's installed, then difflib_rs, which splits the lines
+    on the Rust side as well, and falls back to difflib.
+   """
+   if patiencediff:
+      return patiencediff.unified_diff(text_from.splitlines(), text_to.splitlines(), fromfile=fromfile, tofile=tofile)
+   if unified_diff_str:
+      return iter(unified_diff_str(text_from, text_to, fromfile=fromfile, tofile=tofile))
+   return difflib.unified_diff(text_from.splitlines(), text_to.splitlines(), fromfile=fromfile, tofile=tofile)
 
 def merge_trees(t_HEAD, t_other):
    tree = {}
-   for path, o_HEAD, o_other in compare_trees(t_HEAD, t_other):
-      tree[path] = merge_blobs(o_HEAD, o_other)
+   for path, o_HEAD, o_other in _compare_two(t_HEAD, t_other):
+      if o_HEAD == o_other:
+         # Most files are the same on both sides, they're taken as is
+         tree[path] = data.get_object(o_HEAD)
+      else:
+         tree[path] = merge_blobs(o_HEAD, o_other)
    return tree
 
 def merge_blobs(o_HEAD, o_other):
-   data_HEAD = data.get_object(o_HEAD) if o_HEAD else b""
-   data_other = data.get_object(o_other) if o_other else b""
+   # A file that only one side has, or that both sides have in the same version, has nothing to
+   # merge. Its content is returned without being decoded and diffed against the other side
+   if not o_HEAD:
+      return data.get_object(o_other) if o_other else b""
+   if not o_other or o_HEAD == o_other:
+      return data.get_object(o_HEAD)
+
+   data_HEAD = data.get_object(o_HEAD)
+   data_other = data.get_object(o_other)
 
    # Decode bytes to strings
    data_HEAD_str = data_HEAD.decode("utf-8")
    data_other_str = data_other.decode("utf-8")
 
    # Compute the unified diff
-   diff_ite = difflib.unified_diff(data_HEAD_str.splitlines(), data_other_str.splitlines())
+   diff_ite = _unified_diff(data_HEAD_str, data_other_str)
     
    # Skip over the header in the diff
    for i,c in enumerate(diff_ite):
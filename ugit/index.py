@@ -0,0 +1,61 @@
+import json
+import os
+
+from . import data
+
+"""
+   The index is a cache stored in .ugit/index. For every file hashed by write_tree it remembers
+   the blob OID along with the inode, modification time and size the file had at that moment.
+   As long as those three values are unchanged the file is assumed unchanged as well, so it
+   doesn't have to be read and hashed again (this is the same trick real git's index uses).
+
+   A file modified within the same timestamp tick in which the index was written can't be told
+   apart from its cached version, so entries at least as new as the index file are dropped
+   when it is loaded and those files simply get hashed again.
+
+   The index is stored as JSON, so loading an index from a copied repository can't run code,
+   and since it's only a cache, an index that can't be read is treated as empty.
+"""
+
+INDEX_FILE = 'index'
+
+def load_index():
+   """
+    Loads the index from the repository.
+
+    Returns:
+        dict: A dictionary mapping each path to a (st_ino, st_mtime_ns, st_size, oid) tuple.
+   """
+   path = os.path.join(data.GIT_DIR, INDEX_FILE)
+   try:
+      with open(path, 'rb') as f:
+         index = json.load(f)
+         written = os.fstat(f.fileno()).st_mtime_ns
+      return {path: tuple(entry) for path, entry in index.items() if len(entry) == 4 and entry[1] < written}
+   except (OSError, ValueError, TypeError, AttributeError):
+      # Missing, truncated or otherwise damaged, the files are hashed again and the index rewritten
+      return {}
+
+def save_index(index):
+   # Written to a temporary file and renamed over the index, so it's never seen half-written
+   tmp = data._temp_path(data.GIT_DIR)
+   with open(tmp, 'w') as f:
+      json.dump(index, f, separators=(',', ':'))
+   os.replace(tmp, os.path.join(data.GIT_DIR, INDEX_FILE))
+
+def get_oid(index, path, stat):
+   """
+    Returns the cached OID of the file at the given path, or None if the file changed since it was hashed.
+
+    Args:
+        index (dict): The index, as returned by load_index().
+        path (str): The path of the file.
+        stat (os.stat_result): The current stat of the file.
+   """
+   entry = index.get(path)
+   if entry and entry[:3] == (stat.st_ino, stat.st_mtime_ns, stat.st_size):
+      return entry[3]
+   return None
+
+def make_entry(stat, oid):
+   return stat.st_ino, stat.st_mtime_ns, stat.st_size, oid